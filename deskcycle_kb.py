@@ -1,28 +1,64 @@
 #!/usr/bin/python
-from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, fields
 from enum import Enum
-from typing import List
+from functools import cache, lru_cache, partial
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+import os
 import platform
+import select
+import sys
 import time
 import logging
 
-from marshmallow import ValidationError
-from marshmallow_dataclass import class_schema
-from serial import Serial
+from serial import Serial, SerialException
 from pyautogui import keyDown, keyUp, typewrite, press, isValidKey
 import argparse
 import json
 import serial.tools.list_ports
 
-CONF_PATH = ''
-if platform.system() == 'Linux' or platform.system() == 'Darwin':
-    CONF_PATH = '{}/.config/deskcycle_kb'.format(Path.home())
-elif platform.system() == 'Windows':
-    CONF_PATH = '{}/AppData/Local/deskcycle_kb'.format(Path.home())
-
 DEV_NAME = b'DeskCycle Speedo\r\n'
+# file in the config directory remembering the port the desk cycle was last found on so startup can try it first
+LAST_DEVICE_FILE_NAME = 'last_device'
+# opening the port resets the board, handshakes sent while its bootloader runs are lost so they are retried
+HANDSHAKE_TIMEOUT = 0.3
+HANDSHAKE_ATTEMPTS = 3
 SECONDS_IN_HOUR = 3600
+# converts accumulated mph * nanoseconds to miles
+_INV_NANOSECONDS_IN_HOUR = 1.0 / (SECONDS_IN_HOUR * 1_000_000_000)
+# longest speed line the device sends including \r\n, bounds buffered input when the terminator is lost
+SPEED_FRAME_SIZE = 16
+# seconds a single read may block where select isn't available
+SPEED_TIMEOUT = 0.05
+# seconds to block waiting for the device to start a reply before requesting speed again
+REPLY_WAIT_TIMEOUT = 1.0
+# optional firmware stream mode enabled with --stream: STREAM_START asks the device to send speed lines
+# continuously, acknowledged by a STREAM_ACK line, and STREAM_STOP ends it. Firmware without it ignores the
+# command and speed is polled with b's'
+STREAM_START = b'S'
+STREAM_STOP = b'P'
+STREAM_ACK = b'STREAMING'
+STREAM_ACK_TIMEOUT = 0.3
+# seconds the main loop waits for a sample before checking for interrupts again
+SAMPLE_WAIT_TIMEOUT = 1.0
+# minimum nanoseconds between console status updates
+STATUS_INTERVAL_NS = 100_000_000
+
+# configs often reuse key names across ranges, only ask pyautogui once per unique name
+_is_valid_key = lru_cache(maxsize=512)(isValidKey)
+
+
+@cache
+def _conf_path() -> Path:
+    """
+    Get the config directory for this platform, resolved on first use instead of at import
+    :return: Path of the directory holding config files
+    """
+    return Path.home() / ('AppData/Local/deskcycle_kb' if platform.system() == 'Windows' else '.config/deskcycle_kb')
 
 
 class KeyType(Enum):
@@ -34,7 +70,7 @@ class KeyType(Enum):
     TYPEWRITE_KEY = 'TYPEWRITE_KEY'
 
 
-@dataclass
+@dataclass(slots=True)
 class KeySpeedRange:
     """
     An individual key speed range configuration
@@ -51,27 +87,21 @@ class KeySpeedRange:
     min_speed: float
     max_speed: float = float('inf')
     key_type: KeyType = KeyType.HOLD_KEY
+    # runtime state set up in __post_init__, declared so instances can use slots instead of a __dict__
+    activate: Callable[['KeyboardBatch'], None] = field(init=False, repr=False, compare=False)
+    deactivate: Callable[['KeyboardBatch'], None] = field(init=False, repr=False, compare=False)
+    _is_pressed: bool = field(init=False, default=False, repr=False, compare=False)
+    _is_toggled: bool = field(init=False, default=False, repr=False, compare=False)
 
     def __post_init__(self):
         # everything other than typewrite key requires a valid key
-        if self.key_type != KeyType.TYPEWRITE_KEY and not isValidKey(self.key_name):
-            raise ValidationError('Invalid Key {} for key type {}'.format(self.key_name, self.key_type))
+        if self.key_type != KeyType.TYPEWRITE_KEY and not _is_valid_key(self.key_name):
+            raise ValueError('Invalid Key {} for key type {}'.format(self.key_name, self.key_type))
 
-        # set the activate and deactivate functions based on type and set up the default state where necessary
-        if self.key_type == KeyType.HOLD_KEY:
-            self._is_pressed = False
-            self.activate = self._hold_key_activate
-            self.deactivate = self._hold_key_deactivate
-        elif self.key_type == KeyType.TOGGLE_KEY:
-            self._is_toggled = False
-            self.activate = self._toggle_key_activate
-            self.deactivate = self._toggle_key_deactivate
-        elif self.key_type == KeyType.TYPEWRITE_KEY:
-            self.activate = self._typewrite_key_activate
-            self.deactivate = self._typewrite_key_deactivate
-        else:
-            self.activate = self._default_activate
-            self.deactivate = self._default_deactivate
+        # set the activate and deactivate functions based on type, state fields already default to released
+        activate, deactivate = _KEY_TYPE_HANDLERS.get(self.key_type, _DEFAULT_HANDLERS)
+        self.activate = partial(activate, self)
+        self.deactivate = partial(deactivate, self)
 
     def is_in_range(self, speed: float) -> bool:
         """
@@ -81,175 +111,735 @@ class KeySpeedRange:
         """
         return self.min_speed <= speed <= self.max_speed
 
-    def _hold_key_activate(self):
+    def _hold_key_activate(self, keyboard: 'KeyboardBatch'):
         """
         Handle activation for a hold key. Performs a key down on the key if it isn't already down
+        :param keyboard: batch to queue the key down on
         :return:
         """
         if not self._is_pressed:
-            keyDown(self.key_name)
+            keyboard.key_down(self.key_name)
             self._is_pressed = True
-            logging.debug("Holding {}".format(self.key_name))
+            logging.debug("Holding %s", self.key_name)
 
-    def _toggle_key_activate(self):
+    def _toggle_key_activate(self, keyboard: 'KeyboardBatch'):
         """
         Handle activation for a toggle key. Only presses the key if it isn't already toggled
+        :param keyboard: batch to queue the key press on
         """
         if not self._is_toggled:
-            press(self.key_name)
+            keyboard.press(self.key_name)
             self._is_toggled = True
-            logging.debug("Pressed {}".format(self.key_name))
+            logging.debug("Pressed %s", self.key_name)
 
-    def _typewrite_key_activate(self):
+    def _typewrite_key_activate(self, keyboard: 'KeyboardBatch'):
         """
         Handle activation for a typewrite key. Simply call typewrite with the key_name
+        :param keyboard: batch to queue the typewrite on
         :return:
         """
-        typewrite(self.key_name)
-        logging.debug("Wrote {}".format(self.key_name))
+        keyboard.typewrite(self.key_name)
+        logging.debug("Wrote %s", self.key_name)
 
-    def _default_activate(self):
+    def _default_activate(self, keyboard: 'KeyboardBatch'):
         """
         perform activation for key based on it's type
         """
         pass
 
-    def _hold_key_deactivate(self):
+    def _hold_key_deactivate(self, keyboard: 'KeyboardBatch'):
         """
         Handle deactivation for a hold key. Performs a key up if the key is already down.
+        :param keyboard: batch to queue the key up on
         """
         if self._is_pressed:
-            keyUp(self.key_name)
+            keyboard.key_up(self.key_name)
             self._is_pressed = False
-            logging.debug("Released {}".format(self.key_name))
+            logging.debug("Released %s", self.key_name)
 
-    def _toggle_key_deactivate(self):
+    def _toggle_key_deactivate(self, keyboard: 'KeyboardBatch'):
         """
         Handle deactivation for a toggle key. Only presses the key if it is already toggled effectively un-toggling it.
+        :param keyboard: batch to queue the key press on
         """
         if self._is_toggled:
-            press(self.key_name)
+            keyboard.press(self.key_name)
             self._is_toggled = False
-            logging.debug("Pressed {} Again".format(self.key_name))
+            logging.debug("Pressed %s Again", self.key_name)
 
-    def _typewrite_key_deactivate(self):
+    def _typewrite_key_deactivate(self, keyboard: 'KeyboardBatch'):
         """
         Handle deactivation for typewrite key. Noop since nothing needs to be deactivated.
         """
         pass
 
-    def _default_deactivate(self):
+    def _default_deactivate(self, keyboard: 'KeyboardBatch'):
         """
         perform deactivation for key based on it's type
         """
         pass
 
 
-@dataclass
+# activate and deactivate functions for each key type, bound to the instance in KeySpeedRange.__post_init__
+_KEY_TYPE_HANDLERS = {
+    KeyType.HOLD_KEY: (KeySpeedRange._hold_key_activate, KeySpeedRange._hold_key_deactivate),
+    KeyType.TOGGLE_KEY: (KeySpeedRange._toggle_key_activate, KeySpeedRange._toggle_key_deactivate),
+    KeyType.TYPEWRITE_KEY: (KeySpeedRange._typewrite_key_activate, KeySpeedRange._typewrite_key_deactivate),
+}
+_DEFAULT_HANDLERS = (KeySpeedRange._default_activate, KeySpeedRange._default_deactivate)
+
+
+@dataclass(slots=True)
 class ConfiguredKeys:
     """ Class representation of json structure for key configuration """
     keys: List[KeySpeedRange] = field(default_factory=list)
 
 
-# Schema for deserializing json key configuration
-ConfiguredKeysSchema = class_schema(ConfiguredKeys)
+# fields a key entry may set, the rest of KeySpeedRange is runtime state
+_KEY_SPEED_RANGE_FIELDS = frozenset(f.name for f in fields(KeySpeedRange) if f.init)
+
+
+def _expect_number(entry: dict, name: str, default: Optional[float] = None) -> float:
+    """
+    Get a numeric field from a key entry
+    :param entry: key entry from the json configuration
+    :param name: field name
+    :param default: value when the field is missing, None if the field is required
+    :return: field value as a float
+    """
+    if name not in entry:
+        if default is None:
+            raise ValueError('missing required field {}'.format(name))
+        return default
+    value = entry[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('{} must be a number, got {!r}'.format(name, value))
+    return float(value)
+
+
+def load_configured_keys(config) -> ConfiguredKeys:
+    """
+    Build the key configuration from parsed json
+    :param config: object decoded from a json configuration file
+    :return: ConfiguredKeys for the configuration
+    :raises ValueError: describing the first invalid entry
+    """
+    if not isinstance(config, dict) or not isinstance(config.get('keys', []), list):
+        raise ValueError('configuration must be an object with a keys list')
+
+    configured_keys = ConfiguredKeys()
+    for i, entry in enumerate(config.get('keys', [])):
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError('key must be an object')
+            unknown = entry.keys() - _KEY_SPEED_RANGE_FIELDS
+            if unknown:
+                raise ValueError('unknown fields {}'.format(', '.join(sorted(unknown))))
+            if not isinstance(entry.get('key_name'), str):
+                raise ValueError('key_name must be a string')
+            min_speed = _expect_number(entry, 'min_speed')
+            max_speed = _expect_number(entry, 'max_speed', float('inf'))
+            # also false for NaN bounds, which json allows
+            if not min_speed <= max_speed:
+                raise ValueError('speed range {} to {} is empty'.format(min_speed, max_speed))
+            configured_keys.keys.append(KeySpeedRange(
+                key_name=entry['key_name'],
+                min_speed=min_speed,
+                max_speed=max_speed,
+                key_type=KeyType(entry.get('key_type', KeyType.HOLD_KEY.value)),
+            ))
+        except ValueError as e:
+            raise ValueError('keys[{}]: {}'.format(i, e)) from None
+    return configured_keys
+
+
+class KeyboardBatch:
+    """
+    Collects the keyboard actions of one sample and sends them together on flush.
+    A key up followed by a key down, or two presses, of the same key cancel out, and pyautogui's
+    PAUSE is only slept once after the last call instead of after every call.
+    """
+    __slots__ = ('_actions',)
+
+    def __init__(self):
+        self._actions = []
+
+    def key_down(self, key_name: str):
+        """
+        Queue a key down, cancelling a pending key up of the same key since the key stays down
+        :param key_name: valid name of key
+        """
+        if not self._cancel(keyUp, key_name):
+            self._actions.append((keyDown, key_name))
+
+    def key_up(self, key_name: str):
+        """
+        Queue a key up
+        :param key_name: valid name of key
+        """
+        self._actions.append((keyUp, key_name))
+
+    def press(self, key_name: str):
+        """
+        Queue a key press, cancelling a pending press of the same key since pressing twice is a noop toggle
+        :param key_name: valid name of key
+        """
+        if not self._cancel(press, key_name):
+            self._actions.append((press, key_name))
+
+    def typewrite(self, message: str):
+        """
+        Queue writing a message
+        :param message: text to type
+        """
+        self._actions.append((typewrite, message))
+
+    def flush(self):
+        """
+        Send all queued actions to pyautogui in order and clear the batch
+        """
+        # clear before sending so an interrupt during a call can't replay or cancel against sent actions
+        actions, self._actions = self._actions, []
+        last = len(actions) - 1
+        for i, (action, argument) in enumerate(actions):
+            action(argument, _pause=i == last)
+
+    def _cancel(self, action, key_name: str) -> bool:
+        """
+        Remove the last pending action on key_name if it is the given action
+        :param action: pyautogui function to look for
+        :param key_name: valid name of key
+        :return: True if an action was removed
+        """
+        for i in range(len(self._actions) - 1, -1, -1):
+            pending_action, pending_key_name = self._actions[i]
+            if pending_key_name == key_name and pending_action is not typewrite:
+                if pending_action is action:
+                    del self._actions[i]
+                    return True
+                return False
+        return False
+
+
+class _IntervalNode:
+    """
+    A single node of an IntervalTree
+    center: float
+        Point every interval stored in this node overlaps
+    by_min: List[Tuple[float, float, int]]
+        Intervals overlapping center sorted ascending by low bound
+    mins: List[float]
+        Low bounds of by_min for bisecting
+    by_max: List[Tuple[float, float, int]]
+        Intervals overlapping center sorted ascending by high bound
+    maxes: List[float]
+        High bounds of by_max for bisecting
+    left: _IntervalNode
+        Node holding the intervals entirely below center
+    right: _IntervalNode
+        Node holding the intervals entirely above center
+    """
+    __slots__ = ('center', 'by_min', 'mins', 'by_max', 'maxes', 'left', 'right')
+
+    def __init__(self, intervals: List[Tuple[float, float, int]]):
+        endpoints = sorted(bound for low, high, _ in intervals for bound in (low, high))
+        self.center = endpoints[len(endpoints) // 2]
+
+        overlapping, below, above = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                below.append(interval)
+            elif interval[0] > self.center:
+                above.append(interval)
+            else:
+                overlapping.append(interval)
+
+        self.by_min = sorted(overlapping, key=lambda interval: interval[0])
+        self.mins = [low for low, _, _ in self.by_min]
+        self.by_max = sorted(overlapping, key=lambda interval: interval[1])
+        self.maxes = [high for _, high, _ in self.by_max]
+        self.left = _IntervalNode(below) if below else None
+        self.right = _IntervalNode(above) if above else None
+
+
+class IntervalTree:
+    """
+    Centered interval tree answering which closed intervals contain a point in O(log N + k)
+    """
+    __slots__ = ('_root',)
+
+    def __init__(self, intervals: Iterable[Tuple[float, float, int]]):
+        """
+        Build the tree once from (low, high, data) tuples
+        :param intervals: iterable of (low, high, data) tuples, data is returned by at()
+        """
+        # empty intervals contain no point and would never split into child nodes
+        intervals = [interval for interval in intervals if interval[0] <= interval[1]]
+        self._root = _IntervalNode(intervals) if intervals else None
+
+    def at(self, point: float) -> Set[int]:
+        """
+        Find every interval where low <= point <= high
+        :param point: point to look up
+        :return: set of data for the intervals containing point
+        """
+        found = set()
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                # every interval here ends at or after center, only the low bound needs checking
+                found.update(data for _, _, data in node.by_min[:bisect_right(node.mins, point)])
+                node = node.left
+            elif point > node.center:
+                # every interval here starts at or before center, only the high bound needs checking
+                found.update(data for _, _, data in node.by_max[bisect_left(node.maxes, point):])
+                node = node.right
+            else:
+                found.update(data for _, _, data in node.by_min)
+                break
+        return found
+
+
+class SpeedLookupTable:
+    """
+    Precomputed in range indexes for every segment of the speed axis between range bounds.
+    The in range set can only change at a bound, so a single bisect over the sorted bounds finds the
+    segment of a speed and its set without comparing against any range.
+    Sets are stored as bitmasks where bit i is set when the interval with index i is in range.
+    """
+    __slots__ = ('_bounds', '_segments', '_last_gap')
+
+    def __init__(self, intervals: Iterable[Tuple[float, float, int]]):
+        """
+        Evaluate every segment once with an IntervalTree
+        :param intervals: iterable of (low, high, index) tuples, index is the bit set in at() results
+        """
+        # empty intervals are never in range and their bounds would only add segments
+        intervals = [interval for interval in intervals if interval[0] <= interval[1]]
+        speed_index = IntervalTree(intervals)
+        self._bounds = sorted({bound for low, high, _ in intervals for bound in (low, high)})
+
+        # segment 2i is the open gap below bound i and segment 2i + 1 is bound i itself
+        self._segments = []
+        previous = None
+        for bound in self._bounds:
+            # nothing is in range below the lowest bound
+            if previous is None:
+                self._segments.append(0)
+            else:
+                self._segments.append(_to_mask(speed_index.at(_midpoint(previous, bound))))
+            self._segments.append(_to_mask(speed_index.at(bound)))
+            previous = bound
+        # or above the highest
+        self._segments.append(0)
+
+        # open bounds and mask of the gap last looked up, riders hold a speed band so it's checked before bisecting
+        self._last_gap = (float('inf'), float('-inf'), 0)
+
+    def at(self, speed: float) -> int:
+        """
+        Find every interval where low <= speed <= high
+        :param speed: speed to look up
+        :return: bitmask of the indexes of the intervals containing speed
+        """
+        low, high, in_range = self._last_gap
+        if low < speed < high:
+            return in_range
+
+        i = bisect_left(self._bounds, speed)
+        if i < len(self._bounds) and self._bounds[i] == speed:
+            return self._segments[2 * i + 1]
+        in_range = self._segments[2 * i]
+        low = self._bounds[i - 1] if i > 0 else float('-inf')
+        high = self._bounds[i] if i < len(self._bounds) else float('inf')
+        self._last_gap = (low, high, in_range)
+        return in_range
+
+
+def _midpoint(low: float, high: float) -> float:
+    """
+    Pick a point strictly inside the open gap between two sorted bounds, either of which may be infinite
+    :param low: lower bound of the gap
+    :param high: upper bound of the gap
+    :return: point between low and high
+    """
+    if low == float('-inf'):
+        return 0.0 if high == float('inf') else high - 1
+    if high == float('inf'):
+        return low + 1
+    return low + (high - low) / 2
+
+
+def _to_mask(indexes: Iterable[int]) -> int:
+    """
+    Pack indexes into a bitmask
+    :param indexes: iterable of non negative indexes
+    :return: int with bit i set for every index i
+    """
+    mask = 0
+    for i in indexes:
+        mask |= 1 << i
+    return mask
+
+
+def set_bits(mask: int) -> Iterator[int]:
+    """
+    Iterate the indexes of the set bits of a mask, lowest first
+    :param mask: bitmask to unpack
+    :return: iterator of bit indexes
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def detect_transitions(active: int, in_range: int, repeating: int) -> Tuple[int, int]:
+    """
+    Find the ranges to dispatch for a sample. Only ranges whose state changed are returned,
+    typewrite keys write again on every sample they are in range.
+    :param active: bitmask of the indexes in range on the previous sample
+    :param in_range: bitmask of the indexes in range on this sample
+    :param repeating: bitmask of the indexes of ranges that activate on every sample
+    :return: bitmask of indexes to activate, bitmask of indexes to deactivate
+    """
+    if in_range == active:
+        return in_range & repeating, 0
+    return (in_range & ~active) | (in_range & repeating), active & ~in_range
+
+
+def build_speed_index(key_speed_ranges: List[KeySpeedRange]) -> SpeedLookupTable:
+    """
+    Precompute the in range keys for every speed segment of the configured keys
+    :param key_speed_ranges: List of type KeySpeedRange to index
+    :return: SpeedLookupTable whose lookups return bitmasks of indexes into key_speed_ranges
+    """
+    return SpeedLookupTable((key_speed_range.min_speed, key_speed_range.max_speed, i)
+                            for i, key_speed_range in enumerate(key_speed_ranges))
+
+
+def read_lines(desk_cycle: Serial, pending: bytearray) -> List[bytes]:
+    """
+    Read whatever the desk cycle has sent and split it into lines
+    :param desk_cycle: Serial device with an open desk cycle speedo
+    :param pending: bytes of an unterminated line from the previous read, updated in place
+    :return: complete lines received, without terminators
+    """
+    pending += desk_cycle.read(desk_cycle.in_waiting or 1)
+    *lines, rest = pending.split(b'\n')
+    # a partial line longer than any reply lost its terminator and can never be parsed
+    pending[:] = rest if len(rest) <= SPEED_FRAME_SIZE else b''
+    return lines
 
 
-def calculate_delta_time(previous_time):
+def parse_speed(line: bytes) -> Optional[float]:
     """
-    Get the delta time based on the previous_time argument and the current time
-    :param previous_time: Time to compare against now
-    :return: difference between previous_time and now, now
+    Parse a speed reply line
+    :param line: line received from the desk cycle
+    :return: speed or None if the line is not a number
     """
-    now = time.time()
-    delta_time = now - previous_time
-    return delta_time, now
+    # blank lines and noise are skipped with a plain check, raising ValueError is far slower.
+    # float() allows surrounding whitespace so padded replies are stripped before checking
+    line = line.strip()
+    head = line[:1]
+    if not (head.isdigit() or head in (b'.', b'-', b'+')):
+        return None
+    try:
+        return float(line)
+    except ValueError:
+        logging.debug('Ignoring malformed speed %s', line)
+        return None
 
 
-def main(key_speed_ranges: List[KeySpeedRange], desk_cycle: Serial):
+def enable_low_latency(desk_cycle: Serial):
+    """
+    Ask the serial driver to pass received bytes on immediately instead of batching them (ASYNC_LOW_LATENCY).
+    Only Linux drivers support this, elsewhere the device is left as is.
+    :param desk_cycle: Serial device with an open desk cycle speedo
+    """
+    try:
+        desk_cycle.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError, OSError) as e:
+        logging.debug('Low latency mode unavailable: %s', e)
+
+
+def enable_stream_mode(desk_cycle: Serial) -> bool:
+    """
+    Ask the desk cycle to send speed continuously so the reader doesn't need to poll for every sample
+    :param desk_cycle: Serial device with an open desk cycle speedo
+    :return: True if the device acknowledged stream mode, False if speed must be polled
+    """
+    desk_cycle.reset_input_buffer()
+    desk_cycle.write(STREAM_START)
+    pending = bytearray()
+    deadline = time.monotonic() + STREAM_ACK_TIMEOUT
+    while (remaining := deadline - time.monotonic()) > 0 and wait_readable(desk_cycle, remaining):
+        if any(line.rstrip() == STREAM_ACK for line in read_lines(desk_cycle, pending)):
+            logging.debug('Desk cycle is streaming speed')
+            return True
+    logging.debug('Desk cycle does not support stream mode, polling speed')
+    return False
+
+
+def wait_readable(desk_cycle: Serial, timeout: float) -> bool:
+    """
+    Block until the desk cycle has data to read without spinning on empty reads.
+    Windows serial handles can't be passed to select so there the port timeout does the blocking.
+    :param desk_cycle: Serial device with an open desk cycle speedo
+    :param timeout: maximum seconds to wait
+    :return: True if data may be read
+    """
+    if os.name != 'posix':
+        return True
+    ready, _, _ = select.select([desk_cycle.fileno()], [], [], timeout)
+    return bool(ready)
+
+
+def read_speeds(desk_cycle: Serial, speeds: Queue, stop: Event, streaming: bool):
+    """
+    Read speed from the desk cycle until stop is set. Runs on its own thread so keyboard dispatch never delays polling.
+    :param desk_cycle: Serial device with an open desk cycle speedo
+    :param speeds: single slot queue replaced with the latest (monotonic_ns timestamp, speed) sample, or the
+        exception that stopped reading
+    :param stop: event set when polling should end
+    :param streaming: True if the device is in stream mode and doesn't need to be asked for each speed
+    """
+    pending = bytearray()
+    try:
+        while not stop.is_set():
+            if not streaming:
+                desk_cycle.write(b's')
+
+            # collect whatever has arrived until the reply line is complete, requesting again if it never is
+            lines = []
+            deadline = time.monotonic() + REPLY_WAIT_TIMEOUT
+            while not lines and (remaining := deadline - time.monotonic()) > 0 and wait_readable(desk_cycle, remaining):
+                lines = read_lines(desk_cycle, pending)
+            if not lines:
+                continue
+            # everything waiting was drained, late replies to earlier requests are stale
+            # so only the newest line is used
+            speed = parse_speed(lines[-1])
+            if speed is None:
+                continue
+            _put_latest(speeds, (time.monotonic_ns(), speed))
+    except Exception as e:
+        # hand the error to the main loop so it can release keys and stop instead of waiting forever
+        _put_latest(speeds, e)
+
+
+def _put_latest(speeds: Queue, item):
+    """
+    Put an item in a single slot queue, dropping an unconsumed item for the newer one
+    :param speeds: single slot queue
+    :param item: item to put
+    """
+    try:
+        speeds.put_nowait(item)
+    except Full:
+        try:
+            speeds.get_nowait()
+        except Empty:
+            pass
+        speeds.put_nowait(item)
+
+
+def main(key_speed_ranges: List[KeySpeedRange], desk_cycle: Serial, stream: bool = False):
     """
     Main loop of program
     key_speed_ranges List of type KeySpeedRange containing keys and range they should be pressed in
     desk_cycle Serial device with an open desk cycle speedo
+    stream True to ask the desk cycle for stream mode instead of polling speed
     """
     logging.debug('Starting main loop')
     print('Press Ctr + C to stop')
-    distance_traveled = 0.0
-    previous_time = time.time()
+    # index the ranges once so each sample only visits the ranges containing its speed,
+    # ranges are dispatched in config order
+    speed_index = build_speed_index(key_speed_ranges)
+    # distance is accumulated in mph * nanoseconds and only converted to miles for display
+    distance_traveled_ns_mph = 0.0
+    active = 0
+    # hold and toggle activation is idempotent, only typewrite keys act on every sample
+    repeating = _to_mask(i for i, key_speed_range in enumerate(key_speed_ranges)
+                         if key_speed_range.key_type == KeyType.TYPEWRITE_KEY)
+    keyboard = KeyboardBatch()
+    # resolve the per range handlers once instead of on every sample
+    activations = [key_speed_range.activate for key_speed_range in key_speed_ranges]
+    deactivations = [key_speed_range.deactivate for key_speed_range in key_speed_ranges]
+    desk_cycle.timeout = SPEED_TIMEOUT
+    enable_low_latency(desk_cycle)
+    streaming = stream and enable_stream_mode(desk_cycle)
+    speeds = Queue(maxsize=1)
+    stop = Event()
+    write_status = sys.stdout.write
+    flush_status = sys.stdout.flush
+    last_status_ns = None
+    # taken before the reader starts so the first sample can't be timestamped earlier
+    previous_ns = time.monotonic_ns()
+    reader = Thread(target=read_speeds, args=(desk_cycle, speeds, stop, streaming), name='deskcycle-reader', daemon=True)
+    reader.start()
     try:
         while True:
-            # request speed
-            desk_cycle.write(b's')
-            speed = float(desk_cycle.readline().decode())
-
-            # calculate distance traveled for this loop
-            delta_time, previous_time = calculate_delta_time(previous_time)
-            distance_traveled += (speed / SECONDS_IN_HOUR) * delta_time
-
-            print(f'\tCurrent Speed: {speed:.2f} mph \tDistance Traveled: {distance_traveled:.2f} miles', end='\r', flush=True)
-            # check for keyboard inputs to perform
-            for key_speed_range in key_speed_ranges:
-                key_speed_range.activate() if key_speed_range.is_in_range(speed) else key_speed_range.deactivate()
+            # wait for the reader thread's latest sample, timing out so Ctrl + C is noticed on every platform
+            try:
+                sample = speeds.get(timeout=SAMPLE_WAIT_TIMEOUT)
+            except Empty:
+                if not reader.is_alive():
+                    raise RuntimeError('desk cycle reader stopped unexpectedly')
+                continue
+            if isinstance(sample, Exception):
+                raise sample
+            now_ns, speed = sample
+
+            # calculate distance traveled since the previous sample was read on the monotonic clock
+            distance_traveled_ns_mph += speed * (now_ns - previous_ns)
+            previous_ns = now_ns
+
+            # limit console updates, formatting and writing every sample costs more than it shows
+            if last_status_ns is None or now_ns - last_status_ns >= STATUS_INTERVAL_NS:
+                distance_traveled = distance_traveled_ns_mph * _INV_NANOSECONDS_IN_HOUR
+                write_status(f'\tCurrent Speed: {speed:.2f} mph \tDistance Traveled: {distance_traveled:.2f} miles\r')
+                flush_status()
+                last_status_ns = now_ns
+
+            # an unchanged mask is short circuited by detect_transitions
+            in_range = speed_index.at(speed)
+            to_activate, to_deactivate = detect_transitions(active, in_range, repeating)
+            for i in set_bits(to_deactivate):
+                deactivations[i](keyboard)
+            for i in set_bits(to_activate):
+                activations[i](keyboard)
+            keyboard.flush()
+            active = in_range
     except KeyboardInterrupt:
         print()
-        # ensure all keys are deactivated
-        for key_speed_range in key_speed_ranges:
-            key_speed_range.deactivate()
-
-
-def discover_device():
+    finally:
+        try:
+            # ensure all keys are deactivated, also when reading from the desk cycle failed
+            for deactivate in deactivations:
+                deactivate(keyboard)
+            keyboard.flush()
+        finally:
+            # stop reading even if releasing keys raised, e.g. pyautogui's fail safe
+            stop.set()
+            reader.join()
+            if streaming:
+                desk_cycle.write(STREAM_STOP)
+
+
+def probe_device(port_name: str, timeout: float, stream: bool = False) -> Optional[Serial]:
     """
-    Find a DeskCycle Speedo device
-    :return: Open Serial device
+    Open a serial port and check if a DeskCycle Speedo answers the handshake
+    :param port_name: device path of the serial port
+    :param timeout: seconds to wait for each handshake reply
+    :param stream: True if stream mode was requested and the device may have been left streaming
+    :return: Open Serial device or None if the port isn't a desk cycle
     """
-    for port in serial.tools.list_ports.comports():
-        device = Serial(port.device, 9600, timeout=0.3)
-        attempt = 0
-        while attempt < 3:
+    device = Serial(port_name, 9600, timeout=timeout)
+    try:
+        # a desk cycle left streaming by a run that didn't exit cleanly would answer with speed lines
+        if stream:
+            device.write(STREAM_STOP)
+            device.reset_input_buffer()
+        for _ in range(HANDSHAKE_ATTEMPTS):
             device.write(b'h')
-            handshake = device.readline()
-            if handshake == DEV_NAME:
-                logging.debug('Found desk cycle at {}'.format(port.device))
+            if device.readline() == DEV_NAME:
+                logging.debug('Found desk cycle at %s', port_name)
                 return device
-            else:
-                attempt += 1
+    except Exception:
         device.close()
-    raise RuntimeError('failed to find desk cycle device')
+        raise
+    device.close()
+    return None
+
+
+def discover_device(stream: bool = False):
+    """
+    Find a DeskCycle Speedo device, trying the last device found before scanning every port
+    :param stream: True if stream mode was requested, passed on to probe_device
+    :return: Open Serial device
+    """
+    last_device_file = _conf_path() / LAST_DEVICE_FILE_NAME
+    last_device = None
+    if last_device_file.is_file():
+        last_device = last_device_file.read_text().strip()
+        try:
+            device = probe_device(last_device, HANDSHAKE_TIMEOUT, stream)
+        except SerialException as e:
+            logging.debug('Last device %s unavailable: %s', last_device, e)
+            device = None
+        if device is not None:
+            return device
+
+    # probe every port at once so startup waits for one port's handshakes instead of every port's
+    found = None
+    # the last device already had its handshakes, don't wait for them again
+    port_names = [port.device for port in serial.tools.list_ports.comports() if port.device != last_device]
+    if port_names:
+        with ThreadPoolExecutor(max_workers=len(port_names)) as executor:
+            probes = {executor.submit(probe_device, port_name, HANDSHAKE_TIMEOUT, stream): port_name
+                      for port_name in port_names}
+            for probe in as_completed(probes):
+                try:
+                    device = probe.result()
+                except SerialException as e:
+                    logging.debug('Skipping %s: %s', probes[probe], e)
+                    continue
+                if device is None:
+                    continue
+                if found is None:
+                    found = probes[probe], device
+                else:
+                    device.close()
+    if found is None:
+        raise RuntimeError('failed to find desk cycle device')
+
+    port_name, device = found
+    try:
+        last_device_file.parent.mkdir(parents=True, exist_ok=True)
+        last_device_file.write_text(port_name)
+    except OSError as e:
+        logging.debug('Failed to remember device: %s', e)
+    return device
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Use speed of DeskCycle Speedo to create keyboard inputs')
     parser.add_argument('--file', '-f', dest='keyboard_config', type=str, required=True,
-                        help='Full path to json config or path relative to {}'.format(CONF_PATH))
+                        help='Full path to json config or path relative to the config directory, '
+                             '~/.config/deskcycle_kb or %%USERPROFILE%%\\AppData\\Local\\deskcycle_kb')
     parser.add_argument('--debug', '-d', dest='debug', action='store_true',
                         help='set if you want more logging info')
+    parser.add_argument('--stream', '-s', dest='stream', action='store_true',
+                        help='set if the desk cycle firmware supports streaming speed')
     args = parser.parse_args()
 
     # setup logger
     log_level = logging.DEBUG if args.debug else logging.ERROR
     logging.basicConfig(level=log_level, format='\n%(asctime)s [%(levelname)s] %(message)s', datefmt='%I:%M:%S')
 
-    # find path to config file
-    conf_dir_file = '{}/{}'.format(CONF_PATH, args.keyboard_config)
-    if Path(args.keyboard_config).exists():
-        file_path = args.keyboard_config
-    elif Path(conf_dir_file).exists():
-        file_path = conf_dir_file
-    else:
-        logging.error('cannot find valid config file')
-        exit(1)
+    # find path to config file, as given or relative to the config directory
+    file_path = Path(args.keyboard_config)
+    if not file_path.is_file():
+        file_path = _conf_path() / args.keyboard_config
+        if not file_path.is_file():
+            logging.error('cannot find valid config file')
+            exit(1)
 
     # deserialize configuration file
     with open(file_path) as keyboard_config_file:
         try:
-            configured_keys = ConfiguredKeysSchema().load(json.load(keyboard_config_file))
-        except ValidationError as e:
+            configured_keys = load_configured_keys(json.load(keyboard_config_file))
+        except ValueError as e:
             logging.error(e)
             exit(2)
 
     try:
-        with discover_device() as desk_cycle_dev:
-            main(configured_keys.keys, desk_cycle_dev)
+        with discover_device(args.stream) as desk_cycle_dev:
+            main(configured_keys.keys, desk_cycle_dev, args.stream)
     except RuntimeError as e:
         logging.error(e)
         exit(3)
+    except OSError as e:
+        logging.error('lost connection to desk cycle: %s', e)
+        exit(4)